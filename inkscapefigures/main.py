@@ -2,6 +2,11 @@
 
 import os
 import re
+import functools
+import threading
+import selectors
+import time
+import concurrent.futures
 import logging
 import subprocess
 import textwrap
@@ -18,6 +23,27 @@ from appdirs import user_config_dir
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 log = logging.getLogger('inkscape-figures')
 
+_VERSION_RE = re.compile(r'[0-9.]+')
+
+# Line printed by `fswatch --batch-marker` after each batch of changes
+FSWATCH_BATCH_MARKER = 'NoOp'
+
+# Seconds during which fswatch groups changes into a single batch
+FSWATCH_LATENCY = 0.2
+
+# Seconds without output from fswatch after which pending changes are handled
+FSWATCH_TIMEOUT = FSWATCH_LATENCY
+
+# Printed by `inkscape --shell` when it's ready for the next command
+INKSCAPE_SHELL_PROMPT = b'> '
+
+# Characters with a special meaning to the inkscape shell: actions are
+# separated by semicolons, commands by newlines, and backslashes escape
+INKSCAPE_SHELL_SPECIAL = ';\n\r\\'
+
+# Seconds to wait for the inkscape shell to finish a command
+INKSCAPE_SHELL_TIMEOUT = 60
+
 def inkscape(path):
     with warnings.catch_warnings():
         # leaving a subprocess running after interpreter exit raises a
@@ -25,13 +51,34 @@ def inkscape(path):
         warnings.simplefilter("ignore", ResourceWarning)
         subprocess.Popen(['inkscape', str(path)])
 
+@functools.lru_cache(maxsize=1)
+def _inkscape_version():
+    # The installed inkscape doesn't change while we're running, so only ask
+    # for its version once.
+    inkscape_version = subprocess.check_output(['inkscape', '--version'], universal_newlines=True)
+    log.debug(inkscape_version)
+
+    # Convert
+    # - 'Inkscape 0.92.4 (unknown)' to (0, 92, 4)
+    # - 'Inkscape 1.1-dev (3a9df5bcce, 2020-03-18)' to (1, 1, 0)
+    # - 'Inkscape 1.0rc1' to (1, 0, 0)
+    inkscape_version = _VERSION_RE.search(inkscape_version).group(0)
+    inkscape_version_number = [int(part) for part in inkscape_version.split('.')]
+
+    # Right-pad the array with zeros (so [1, 1] becomes [1, 1, 0])
+    inkscape_version_number = inkscape_version_number + [0] * (3 - len(inkscape_version_number))
+    return tuple(inkscape_version_number)
+
 def indent(text, indentation=0):
-    lines = text.split('\n');
-    return '\n'.join(" " * indentation + line for line in lines)
+    # Unlike the default, also indent blank lines
+    return textwrap.indent(text, " " * indentation, lambda line: True)
+
+_BEAUTIFY_TABLE = str.maketrans({'_': ' ', '-': ' '})
 
 def beautify(name):
-    return name.replace('_', ' ').replace('-', ' ').title()
+    return name.translate(_BEAUTIFY_TABLE).title()
 
+@functools.lru_cache(maxsize=256)
 def latex_template(name, title):
     return '\n'.join((
         r"\begin{figure}[ht]",
@@ -71,21 +118,54 @@ if not template.is_file():
 
 if config.exists():
     config_module = import_file('config', config)
-    latex_template = config_module.latex_template
+    latex_template = functools.lru_cache(maxsize=256)(config_module.latex_template)
+
+
+# The parsed roots file, only reread when its modification time or size
+# changes. (Two writes can happen within the same timestamp tick, but as the
+# file is only appended to, its size changes with every new root.) The set of
+# roots is kept next to the list for fast membership checks.
+_roots_cache = {'stat': None, 'roots': [], 'roots_set': set()}
+
+
+def _roots_file_stat():
+    stat = roots_file.stat()
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _load_roots():
+    stat = _roots_file_stat()
+    if stat != _roots_cache['stat']:
+        _roots_cache['roots'] = [root.strip() for root in roots_file.read_text().split('\n')
+                                 if root.strip() != '']
+        _roots_cache['roots_set'] = set(_roots_cache['roots'])
+        _roots_cache['stat'] = stat
+    return _roots_cache['roots']
 
 
 def add_root(path):
     path = str(path)
-    roots = get_roots()
-    if path in roots:
+    roots = _load_roots()
+    if path in _roots_cache['roots_set']:
         return None
 
     roots.append(path)
-    roots_file.write_text('\n'.join(roots))
+    _roots_cache['roots_set'].add(path)
+
+    # Only append the new root rather than rewriting the whole file
+    with roots_file.open('ab+') as f:
+        # Older versions didn't end the file with a newline
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.write(os.fsencode(path) + b'\n')
+
+    _roots_cache['stat'] = _roots_file_stat()
 
 
 def get_roots():
-    return [root for root in roots_file.read_text().split('\n') if root != '']
+    return list(_load_roots())
 
 
 @click.group()
@@ -104,6 +184,8 @@ def watch(daemon):
     else:
         watcher_cmd = watch_daemon_fswatch
 
+    _detect_inkscape()
+
     if daemon:
         daemon = Daemonize(app='inkscape-figures',
                            pid='/tmp/inkscape-figures.pid',
@@ -115,107 +197,348 @@ def watch(daemon):
         watcher_cmd()
 
 
+# Set up by _detect_inkscape when the watcher starts
+_build_cmd = None
+_use_shell = False
+
+
+def _detect_inkscape():
+    """
+    Choose how to export figures for the installed inkscape version, so that
+    the version doesn't have to be checked for every figure.
+    """
+    global _build_cmd, _use_shell
+
+    # Tuple comparison is like version comparison
+    if _inkscape_version() < (1, 0, 0):
+        def _build_cmd(filepath, pdf_path):
+            return [
+                'inkscape',
+                '--export-area-page',
+                '--export-dpi', '300',
+                '--export-pdf', pdf_path,
+                '--export-latex', filepath
+                ]
+    else:
+        def _build_cmd(filepath, pdf_path):
+            return [
+                'inkscape', filepath,
+                '--export-area-page',
+                '--export-dpi', '300',
+                '--export-type=pdf',
+                '--export-latex',
+                '--export-filename', pdf_path
+                ]
+
+    # Inkscape 1.1+ can export from its shell, which saves starting up a new
+    # inkscape for every figure. (The shell of 1.0 can't close documents.)
+    _use_shell = _inkscape_version() >= (1, 1, 0)
+
+
+# Long-running `inkscape --shell` process, started on the first export
+_shell = None
+_shell_lock = threading.Lock()
+
+
+def _read_shell_prompt(process):
+    # Give up if the prompt doesn't come back in time, rather than blocking
+    # every later export on the shell lock.
+    deadline = time.monotonic() + INKSCAPE_SHELL_TIMEOUT
+    output = b''
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ)
+        while not output.endswith(INKSCAPE_SHELL_PROMPT):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or not selector.select(timeout=timeout):
+                raise TimeoutError('Inkscape shell did not respond')
+            data = os.read(process.stdout.fileno(), 4096)
+            if not data:
+                raise EOFError('Inkscape shell exited')
+            output += data
+    return output
+
+
+def _export_in_shell(filepath, pdf_path):
+    """
+    Export an svg file to pdf using the inkscape shell. Returns False if the
+    shell is not available or the export failed.
+    """
+    # Leave paths the action parser could misread to the one-shot command
+    for path in (str(filepath), str(pdf_path)):
+        if path != path.strip() or any(c in path for c in INKSCAPE_SHELL_SPECIAL):
+            return False
+
+    command = ('file-open:{}; export-area-page; export-dpi:300; '
+               'export-type:pdf; export-latex; export-filename:{}; '
+               'export-do; file-close\n').format(filepath, pdf_path)
+
+    # The shell doesn't report whether the export worked, so check that the
+    # pdf was written.
+    try:
+        pdf_mtime = os.stat(pdf_path).st_mtime_ns
+    except FileNotFoundError:
+        pdf_mtime = None
+
+    # The shell handles one command at a time
+    with _shell_lock:
+        if not _run_in_shell(command):
+            return False
+
+    try:
+        exported = os.stat(pdf_path).st_mtime_ns != pdf_mtime
+    except FileNotFoundError:
+        exported = False
+
+    if not exported:
+        log.error('Inkscape shell did not export %s', filepath)
+    return exported
+
+
+def _run_in_shell(command):
+    global _shell, _use_shell
+
+    try:
+        if _shell is None or _shell.poll() is not None:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", ResourceWarning)
+                _shell = subprocess.Popen(
+                        ['inkscape', '--shell'], stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE)
+            _read_shell_prompt(_shell)
+
+        log.debug('Running shell command:')
+        log.debug(textwrap.indent(command, '    '))
+        _shell.stdin.write(command.encode())
+        _shell.stdin.flush()
+        _read_shell_prompt(_shell)
+    except (OSError, EOFError):
+        # Don't pay for starting (and possibly timing out on) a shell that
+        # doesn't work on every save, use the one-shot command from now on.
+        log.warning('Inkscape shell is not available, no longer using it',
+                    exc_info=True)
+        if _shell is not None:
+            _shell.kill()
+            _shell.wait()
+        _shell = None
+        _use_shell = False
+        return False
+
+    return True
+
+
+# Maps the path of each compiled svg to its (mtime, size) at compile time
+_compiled = {}
+
+
 def maybe_recompile_figure(filepath):
-    filepath = Path(filepath)
+    """
+    Returns a function which recompiles the figure and returns its name, or
+    None if the file doesn't need to be recompiled. The function takes
+    whether the inkscape shell may be used.
+    """
+    # Plain strings are used rather than Path objects, as this runs for every
+    # changed file.
+    filepath = os.fspath(filepath)
+    root, ext = os.path.splitext(filepath)
     # A file has changed
-    if filepath.suffix != '.svg':
-        log.debug('File has changed, but is nog an svg {}'.format(
-            filepath.suffix))
-        return
+    if ext != '.svg':
+        log.debug('File has changed, but is nog an svg {}'.format(ext))
+        return None
+
+    # Inkscape can trigger several events for a single save, only recompile
+    # if the file actually changed since the last time.
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        log.debug('File has changed, but no longer exists %s', filepath)
+        return None
+    state = (stat.st_mtime_ns, stat.st_size)
+    if _compiled.get(filepath) == state:
+        log.debug('File has not changed since last compile %s', filepath)
+        return None
 
-    log.info('Recompiling %s', filepath)
+    pdf_path = root + '.pdf'
+    name = os.path.basename(root)
 
-    pdf_path = filepath.parent / (filepath.stem + '.pdf')
-    name = filepath.stem
+    def recompile(use_shell=True):
+        log.info('Recompiling %s', filepath)
 
-    inkscape_version = subprocess.check_output(['inkscape', '--version'], universal_newlines=True)
-    log.debug(inkscape_version)
+        succeeded = use_shell and _use_shell and _export_in_shell(filepath, pdf_path)
 
-    # Convert
-    # - 'Inkscape 0.92.4 (unknown)' to [0, 92, 4]
-    # - 'Inkscape 1.1-dev (3a9df5bcce, 2020-03-18)' to [1, 1]
-    # - 'Inkscape 1.0rc1' to [1, 0]
-    inkscape_version = re.findall(r'[0-9.]+', inkscape_version)[0]
-    inkscape_version_number = [int(part) for part in inkscape_version.split('.')]
+        if not succeeded:
+            command = _build_cmd(filepath, pdf_path)
 
-    # Right-pad the array with zeros (so [1, 1] becomes [1, 1, 0])
-    inkscape_version_number= inkscape_version_number + [0] * (3 - len(inkscape_version_number))
+            log.debug('Running command:')
+            log.debug(textwrap.indent(' '.join(str(e) for e in command), '    '))
+
+            # Recompile the svg file
+            completed_process = subprocess.run(command, stdin=subprocess.DEVNULL)
+
+            succeeded = completed_process.returncode == 0
+            if not succeeded:
+                log.error('Return code %s', completed_process.returncode)
+
+        if succeeded:
+            log.debug('Command succeeded')
+            _compiled[filepath] = state
+
+        return name
+
+    return recompile
+
+
+# Runs the exports of a batch of changed figures in parallel, created when
+# the first batch comes in
+_executor = None
+
+
+def recompile_figures(filepaths):
+    """
+    Recompiles the changed figures among filepaths in parallel, then copies
+    the LaTeX code of the last one to the clipboard.
+    """
+    global _executor
+
+    recompiles = []
+    for filepath in filepaths:
+        recompile = maybe_recompile_figure(filepath)
+        if recompile is not None:
+            recompiles.append(recompile)
+
+    if not recompiles:
+        return
+
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+
+    # The inkscape shell exports one figure at a time, so export batches of
+    # several figures with separate inkscape processes instead.
+    use_shell = len(recompiles) == 1
+    futures = [_executor.submit(recompile, use_shell) for recompile in recompiles]
+
+    name = None
+    for future in futures:
+        try:
+            name = future.result()
+        except Exception:
+            log.exception('Could not recompile figure')
+
+    if name is not None:
+        copy_latex_template(name)
 
-    # Tuple comparison is like version comparison
-    if inkscape_version_number < [1, 0, 0]:
-        command = [
-            'inkscape',
-            '--export-area-page',
-            '--export-dpi', '300',
-            '--export-pdf', pdf_path,
-            '--export-latex', filepath
-            ]
-    else:
-        command = [
-            'inkscape', filepath,
-            '--export-area-page',
-            '--export-dpi', '300',
-            '--export-type=pdf',
-            '--export-latex',
-            '--export-filename', pdf_path
-            ]
-
-    log.debug('Running command:')
-    log.debug(textwrap.indent(' '.join(str(e) for e in command), '    '))
-
-    # Recompile the svg file
-    completed_process = subprocess.run(command)
-
-    if completed_process.returncode != 0:
-        log.error('Return code %s', completed_process.returncode)
-    else:
-        log.debug('Command succeeded')
 
+def copy_latex_template(name):
     # Copy the LaTeX code to include the file to the clipboard
     template = latex_template(name, beautify(name))
     pyperclip.copy(template)
     log.debug('Copying LaTeX template:')
     log.debug(textwrap.indent(template, '    '))
 
+
 def watch_daemon_inotify():
     import inotify.adapters
-    from inotify.constants import IN_CLOSE_WRITE
+    from inotify.constants import (IN_CLOSE_WRITE, IN_MOVED_TO,
+                                   IN_DELETE_SELF, IN_MOVE_SELF)
 
-    while True:
-        roots = get_roots()
+    # Files written in place trigger IN_CLOSE_WRITE, files written to a
+    # temporary file and renamed into place trigger IN_MOVED_TO.
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO
+    event_names = {'IN_CLOSE_WRITE', 'IN_MOVED_TO'}
+
+    i = inotify.adapters.Inotify()
+
+    # Watch the directory containing the roots file (the file which contains
+    # the paths to watch) rather than the file itself, so that we don't lose
+    # track of it when it gets replaced. When it changes, we update the
+    # watches.
+    i.add_watch(str(user_dir), mask=mask)
 
-        # Watch the file with contains the paths to watch
-        # When this file changes, we update the watches.
-        i = inotify.adapters.Inotify()
-        i.add_watch(str(roots_file), mask=IN_CLOSE_WRITE)
+    # Figure directories currently watched
+    active_watches = set()
 
-        # Watch the actual figure directories
-        log.info('Watching directories: ' + ', '.join(get_roots()))
-        for root in roots:
+    # Also be told when a figure directory itself goes away, so that its
+    # watch is added again on the next update if it comes back
+    root_mask = mask | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def update_watches():
+        # Different spellings of the same directory only need one watch
+        roots = {os.path.realpath(root) for root in get_roots()}
+        log.info('Watching directories: ' + ', '.join(sorted(roots)))
+
+        # Only touch the watches of the roots which were added or removed
+        for root in active_watches - roots:
             try:
-                i.add_watch(root, mask=IN_CLOSE_WRITE)
+                i.remove_watch(root)
+                log.debug('Removed root %s', root)
             except Exception:
-                log.debug('Could not add root %s', root)
+                log.debug('Could not remove root %s', root)
+            active_watches.discard(root)
 
-        for event in i.event_gen(yield_nones=False):
-            (_, type_names, path, filename) = event
+        for root in roots - active_watches:
+            try:
+                i.add_watch(root, mask=root_mask)
+                active_watches.add(root)
+            except Exception:
+                log.debug('Could not add root %s', root)
 
+    # Watch the actual figure directories
+    update_watches()
+
+    # Changed files are collected until all events read at once have been
+    # handled, so that they're recompiled together. (A dict is used as an
+    # ordered set.)
+    batch = {}
+
+    for event in i.event_gen(yield_nones=True):
+        if event is None:
+            if batch:
+                recompile_figures(batch)
+                batch = {}
+            continue
+
+        (_, type_names, path, filename) = event
+
+        if path in active_watches:
+            # The kernel drops the watch of a deleted directory by itself
+            if 'IN_IGNORED' in type_names or 'IN_DELETE_SELF' in type_names:
+                log.debug('Root has been removed %s', path)
+                # Older versions of inotify ignore `superficial` and fail
+                # to remove the watch again, after having forgotten it.
+                try:
+                    i.remove_watch(path, superficial=True)
+                except Exception:
+                    log.debug('Could not remove root %s', path)
+                active_watches.discard(path)
+                continue
+
+            # The watch of a moved directory follows it to its new location
+            if 'IN_MOVE_SELF' in type_names:
+                log.debug('Root has been moved %s', path)
+                try:
+                    i.remove_watch(path)
+                except Exception:
+                    log.debug('Could not remove root %s', path)
+                active_watches.discard(path)
+                continue
+
+        if event_names.isdisjoint(type_names):
+            continue
+
+        if path == str(user_dir):
             # If the file containing figure roots has changes, update the
             # watches
-            if path == str(roots_file):
+            if filename == roots_file.name:
                 log.info('The roots file has been updated. Updating watches.')
-                for root in roots:
-                    try:
-                        i.remove_watch(root)
-                        log.debug('Removed root %s', root)
-                    except Exception:
-                        log.debug('Could not remove root %s', root)
-                # Break out of the loop, setting up new watches.
-                break
+                update_watches()
+            continue
+
+        # A file has changed
+        path = os.path.join(path, filename)
 
-            # A file has changed
-            path = Path(path) / filename
-            maybe_recompile_figure(path)
+        # Move files which changed again to the end, so that the most
+        # recently changed file ends up in the clipboard
+        batch.pop(path, None)
+        batch[path] = None
 
 
 def watch_daemon_fswatch():
@@ -228,21 +551,67 @@ def watch_daemon_fswatch():
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", ResourceWarning)
             p = subprocess.Popen(
-                    ['fswatch', *roots, str(user_dir)], stdout=subprocess.PIPE,
-                    universal_newlines=True)
-
-        while True:
-            filepath = p.stdout.readline().strip()
+                    ['fswatch', '--batch-marker',
+                     '--latency', str(FSWATCH_LATENCY),
+                     *roots, str(user_dir)],
+                    stdout=subprocess.PIPE)
+
+        # Wait for output with a timeout rather than blocking on readline, so
+        # that pending changes are handled even if fswatch goes quiet, and we
+        # notice when fswatch exits.
+        selector = selectors.DefaultSelector()
+        selector.register(p.stdout, selectors.EVENT_READ)
+
+        # fswatch groups the changes of each latency window into a batch,
+        # followed by a marker line. Collect the paths of a batch so that a
+        # file which changed several times is only recompiled once. (A dict
+        # is used as an ordered set.)
+        batch = {}
+        buffer = b''
+        restart = False
+        while not restart:
+            flush = not selector.select(timeout=FSWATCH_TIMEOUT)
+            if not flush:
+                data = os.read(p.stdout.fileno(), 4096)
+                if not data:
+                    log.error('fswatch exited with code %s', p.wait())
+                    time.sleep(1)
+                    flush = restart = True
+
+                lines = (buffer + data).split(b'\n')
+                # Keep an incomplete last line for the next read, unless
+                # fswatch has exited
+                buffer = lines.pop() if data else b''
+                for line in lines:
+                    filepath = os.fsdecode(line).strip()
+                    if filepath == FSWATCH_BATCH_MARKER:
+                        flush = True
+                    elif filepath:
+                        # Move files which changed again to the end, so that
+                        # the most recently changed file ends up in the
+                        # clipboard
+                        batch.pop(filepath, None)
+                        batch[filepath] = None
+
+            if not flush or not batch:
+                continue
+
+            recompile_figures(filepath for filepath in batch
+                              if filepath != str(roots_file))
 
             # If the file containing figure roots has changes, update the
             # watches
-            if filepath == str(roots_file):
+            if str(roots_file) in batch:
                 log.info('The roots file has been updated. Updating watches.')
                 p.terminate()
+                p.wait()
                 log.debug('Removed main watch %s')
-                break
-            maybe_recompile_figure(filepath)
+                restart = True
 
+            batch = {}
+
+        selector.close()
+        p.stdout.close()
 
 
 @cli.command()
@@ -297,9 +666,13 @@ def edit(root):
 
     figures = Path(root).absolute()
 
-    # Find svg files and sort them
-    files = figures.glob('*.svg')
-    files = sorted(files, key=lambda f: f.stat().st_mtime, reverse=True)
+    # Find svg files and sort them, most recently modified first
+    with os.scandir(str(figures)) as entries:
+        files = sorted(
+            ((entry.stat().st_mtime, entry.path) for entry in entries
+             if entry.name.endswith('.svg')),
+            reverse=True)
+    files = [Path(path) for _, path in files]
 
     # Open a selection dialog using a gui picker like rofi
     names = [beautify(f.stem) for f in files]
@@ -308,12 +681,7 @@ def edit(root):
         path = files[index]
         add_root(figures)
         inkscape(path)
-
-        # Copy the LaTeX code to include the file to the clipboard
-        template = latex_template(path.stem, beautify(path.stem))
-        pyperclip.copy(template)
-        log.debug('Copying LaTeX template:')
-        log.debug(textwrap.indent(template, '    '))
+        copy_latex_template(path.stem)
 
 if __name__ == '__main__':
     cli()